@@ -0,0 +1,199 @@
+"""Fuzzy canonicalization of free-text "other" answers.
+
+Misspelled write-ins ("sodda", "rolie polie") are mapped to the nearest
+choice `value` of the same question by trigram similarity, scaled down when
+the word counts differ so that "soda pop" stays its own term. Candidates come
+from a trigram inverted index joined against the choice values, so only
+strings sharing a trigram with a choice are ever scored -- no all-pairs
+comparison. Best matches are persisted and only new strings are scored on
+later runs.
+"""
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Bump whenever scoring changes so persisted similarities are rebuilt
+MAP_VERSION = 2
+MAP_PATH = Path("data") / f"other_term_map_v{MAP_VERSION}.csv"
+DEFAULT_MIN_SIMILARITY = 0.5
+
+# Hand-written folds for variants trigrams miss, keyed by question_id
+VARIANT_PATTERNS = {
+    21: [(r'^(roly|rollie|rolly|roley)[\s\-]*poly.*$', 'roly poly')],  # Roly poly question
+}
+
+_WORD_SPLIT = re.compile(r"[^a-z0-9]+")
+MAP_COLUMNS = ["question_id", "other", "canonical", "similarity"]
+
+
+def clean_terms(series):
+    # Object first: a column with no text at all is read back as float
+    return series.astype(object).str.strip().str.lower()
+
+
+def trigrams(text):
+    """Trigrams of each word, padded with two leading spaces and one trailing space."""
+    grams = set()
+    for word in _WORD_SPLIT.split(text.lower()):
+        if word:
+            padded = f"  {word} "
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def word_count(text):
+    return sum(1 for word in _WORD_SPLIT.split(text.lower()) if word)
+
+
+def trigram_index(strings, question_ids):
+    """Inverted index as a long frame of (question_id, trigram, row) postings.
+
+    Also returns the trigram and word counts of each string, needed for
+    similarity.
+    """
+    grams = [trigrams(s) for s in strings]
+    sizes = np.array([len(g) for g in grams], dtype=int)
+    words = np.array([word_count(s) for s in strings], dtype=int)
+    rows = np.repeat(np.arange(len(grams)), sizes)
+
+    postings = pd.DataFrame({
+        "question_id": np.asarray(question_ids)[rows],
+        "trigram": [gram for g in grams for gram in g],
+        "row": rows,
+    })
+    return postings, sizes, words
+
+
+def match_others(others, canonical):
+    """Nearest canonical value for each distinct free-text answer.
+
+    `others` and `canonical` have `question_id` and `term` columns. Returns
+    one row per answer with its best `canonical` value from the same question
+    and its `similarity` (0 and NaN when nothing overlaps): the trigram
+    Jaccard index times the ratio of the smaller to the larger word count,
+    so an answer that merely contains a choice as one of its words
+    ("soda pop", "diet coke") is not folded into it.
+
+    >>> others = pd.DataFrame({"question_id": [2, 2, 2, 21],
+    ...                        "term": ["sodda", "soda pop", "diet coke", "rolie polie"]})
+    >>> canonical = pd.DataFrame({"question_id": [2, 2, 2, 21, 21],
+    ...                           "term": ["soda", "pop", "coke", "roly poly", "pill bug"]})
+    >>> matched = match_others(others, canonical)
+    >>> matched.loc[matched["similarity"] >= DEFAULT_MIN_SIMILARITY, "other"].tolist()
+    ['sodda', 'rolie polie']
+    """
+    others = others.reset_index(drop=True)
+    canonical = canonical.reset_index(drop=True)
+
+    other_postings, other_sizes, other_words = trigram_index(others["term"], others["question_id"])
+    canon_postings, canon_sizes, canon_words = trigram_index(canonical["term"], canonical["question_id"])
+
+    # Candidate retrieval: only (answer, choice) pairs sharing a trigram meet here
+    pairs = other_postings.merge(
+        canon_postings, on=["question_id", "trigram"], suffixes=("_other", "_canon")
+    )
+    shared = pairs.groupby(["row_other", "row_canon"]).size().reset_index(name="shared")
+
+    union = (
+        other_sizes[shared["row_other"].to_numpy()]
+        + canon_sizes[shared["row_canon"].to_numpy()]
+        - shared["shared"].to_numpy()
+    )
+    words_other = other_words[shared["row_other"].to_numpy()]
+    words_canon = canon_words[shared["row_canon"].to_numpy()]
+    word_ratio = (
+        np.minimum(words_other, words_canon) / np.maximum(np.maximum(words_other, words_canon), 1)
+    )
+    shared["similarity"] = shared["shared"] / union * word_ratio
+    best = (
+        shared.sort_values(["row_other", "similarity"], ascending=[True, False], kind="stable")
+        .drop_duplicates("row_other")
+    )
+
+    # Answers without a candidate are kept too, so they are not rescored
+    matched = pd.DataFrame({
+        "question_id": others["question_id"],
+        "other": others["term"],
+        "canonical": pd.Series(np.nan, index=others.index, dtype=object),
+        "similarity": 0.0,
+    })
+    matched.loc[best["row_other"], "canonical"] = canonical["term"].to_numpy()[best["row_canon"]]
+    matched.loc[best["row_other"], "similarity"] = best["similarity"].to_numpy()
+    return matched[MAP_COLUMNS]
+
+
+def load_term_map(path=MAP_PATH):
+    if not path.exists():
+        return pd.DataFrame(columns=MAP_COLUMNS)
+    # Answers like "none" or "null" are real strings, not missing values
+    term_map = pd.read_csv(path, keep_default_na=False, dtype={"other": str, "canonical": str})
+    term_map["canonical"] = term_map["canonical"].replace("", np.nan)
+    return term_map
+
+
+def save_term_map(term_map, path=MAP_PATH):
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    term_map.to_csv(tmp, index=False)
+    tmp.replace(path)
+
+
+def update_term_map(joined, path=MAP_PATH):
+    """Persisted answer -> choice map, extended with any answers not seen before.
+
+    `joined` needs `question_id`, `value` and `other`. The map keeps every
+    best match with its similarity, so thresholds are applied at lookup time
+    and changing them needs no rebuild. Delete the file to rescore everything
+    (e.g. after choices change).
+    """
+    joined = joined.dropna(subset=["question_id"])
+
+    answered = joined.dropna(subset=["other"])
+    others = pd.DataFrame({
+        "question_id": answered["question_id"],
+        "term": clean_terms(answered["other"]),
+    }).dropna().drop_duplicates()
+    others = others[others["term"] != ""]
+
+    canonical = pd.DataFrame({
+        "question_id": joined["question_id"],
+        "term": clean_terms(joined["value"]),
+    }).dropna().drop_duplicates()
+
+    term_map = load_term_map(path)
+    known = pd.MultiIndex.from_frame(term_map[["question_id", "other"]])
+    new = others[~pd.MultiIndex.from_frame(others[["question_id", "term"]]).isin(known)]
+
+    if not new.empty:
+        matched = match_others(new, canonical)
+        term_map = matched if term_map.empty else pd.concat([term_map, matched], ignore_index=True)
+        save_term_map(term_map, path)
+    return term_map
+
+
+def canonical_terms(df, term_map, min_similarity=DEFAULT_MIN_SIMILARITY):
+    """Cleaned `value`, else the matched choice for `other`, else cleaned `other`.
+
+    Free-text answers map to a choice only when their similarity is at least
+    `min_similarity`. VARIANT_PATTERNS are applied last.
+    """
+    other = clean_terms(df["other"])
+
+    accepted = term_map[
+        (term_map["similarity"] >= min_similarity) & term_map["canonical"].notna()
+    ]
+    lookup = pd.MultiIndex.from_frame(accepted[["question_id", "other"]])
+    pos = lookup.get_indexer(pd.MultiIndex.from_arrays([df["question_id"], other]))
+
+    mapped = other.to_numpy(dtype=object, copy=True)
+    hit = pos >= 0
+    mapped[hit] = accepted["canonical"].to_numpy()[pos[hit]]
+    terms = clean_terms(df["value"]).combine_first(pd.Series(mapped, index=df.index))
+
+    for question_id, patterns in VARIANT_PATTERNS.items():
+        in_question = df["question_id"] == question_id
+        for pattern, replacement in patterns:
+            terms[in_question] = terms[in_question].str.replace(pattern, replacement, regex=True)
+    return terms
@@ -0,0 +1,150 @@
+"""Stratified response samples for fast approximate charts.
+
+The Visualization page draws from a persisted sample, stratified by
+question and state, while the exact aggregation over all responses runs in
+a background thread. Estimators take a `weight` column so the same code
+serves both the sample and the full table (weight 1).
+"""
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SAMPLE_PATH = Path("data") / "response_sample.csv"
+Z_95 = 1.96
+
+
+def stratified_sample(joined, question_ids=None, per_stratum=50, seed=0):
+    """Up to `per_stratum` responses from each (question_id, state) stratum.
+
+    Only `question_ids` are sampled when given, which keeps the file small
+    enough to load in well under a second. Each sampled row carries `weight` = stratum size / rows sampled, so
+    weighted sums estimate full-table counts.
+    """
+    if question_ids is not None:
+        joined = joined[joined["question_id"].isin(question_ids)]
+
+    rng = np.random.default_rng(seed)
+    shuffled = joined.iloc[rng.permutation(len(joined))]
+
+    strata = shuffled.groupby(["question_id", "state"], dropna=False, sort=False)
+    sizes = strata["question_id"].transform("size")
+    keep = strata.cumcount() < per_stratum
+
+    sample = shuffled[keep].copy()
+    sample["weight"] = (sizes / np.minimum(sizes, per_stratum))[keep]
+    return sample.sort_index()
+
+
+def save_sample(sample, path=SAMPLE_PATH):
+    # Write then rename so a page run never reads a half-written file
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    sample.to_csv(tmp, index=False)
+    tmp.replace(path)
+
+
+def load_sample(path=SAMPLE_PATH):
+    return pd.read_csv(path, low_memory=False)
+
+
+def weighted_shares(df, group_col, term_col="term", weight_col="weight"):
+    """Per-group term shares with 95% confidence intervals.
+
+    Returns `group_col`, `term_col`, estimated `count`, and `percent` with
+    `ci_low`/`ci_high` bounds. Intervals use the normal approximation with
+    Kish's effective sample size to account for unequal weights.
+    """
+    df = df.assign(_w2=df[weight_col] ** 2)
+
+    counts = (
+        df.groupby([group_col, term_col], observed=True)[weight_col]
+        .sum()
+        .reset_index(name="count")
+    )
+    totals = df.groupby(group_col, observed=True).agg(
+        total=(weight_col, "sum"), total_sq=("_w2", "sum")
+    )
+    counts = counts.join(totals, on=group_col)
+
+    p = counts["count"] / counts["total"]
+    n_eff = counts["total"] ** 2 / counts["total_sq"]
+    half = Z_95 * np.sqrt(p * (1 - p) / n_eff)
+
+    counts["percent"] = (p * 100).round(1)
+    counts["ci_low"] = ((p - half).clip(lower=0) * 100).round(1)
+    counts["ci_high"] = ((p + half).clip(upper=1) * 100).round(1)
+    return counts.drop(columns=["total", "total_sq"])
+
+
+def _entropy(counts):
+    """Shannon entropy (bits) along the last axis of an array of term counts."""
+    p = counts / counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cells = np.where(p > 0, -p * np.log2(p), 0.0)
+    # Clip rounding error and turn -0.0 into 0.0
+    return np.maximum(cells.sum(axis=-1), 0.0) + 0.0
+
+
+def weighted_entropy(df, group_col, term_col="term", weight_col="weight",
+                     n_boot=200, seed=0):
+    """Shannon entropy (bits) of the term distribution per group.
+
+    `ci_low`/`ci_high` are a 95% percentile bootstrap over the group's rows
+    (NaN when `n_boot` is 0). A group showing a single term can't vary under
+    resampling, so its upper bound is instead the entropy of an unseen term
+    at the rule-of-three rate 3 / n_eff.
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+
+    for group, sub in df.groupby(group_col, observed=True, sort=True):
+        codes, uniques = pd.factorize(sub[term_col])
+        w = sub[weight_col].to_numpy(dtype=float)
+        k = len(uniques)
+        entropy = _entropy(np.bincount(codes, weights=w, minlength=k))
+
+        ci_low = ci_high = np.nan
+        if n_boot > 0:
+            draws = rng.integers(0, len(sub), size=(n_boot, len(sub)))
+            flat = (np.arange(n_boot)[:, None] * k + codes[draws]).ravel()
+            boot = _entropy(np.bincount(
+                flat, weights=w[draws].ravel(), minlength=n_boot * k
+            ).reshape(n_boot, k))
+            ci_low, ci_high = np.percentile(boot, [2.5, 97.5])
+
+            if k == 1:
+                n_eff = w.sum() ** 2 / (w ** 2).sum()
+                unseen = min(3 / n_eff, 0.5)
+                ci_high = _entropy(np.array([1 - unseen, unseen]))
+
+        records.append({group_col: group, "entropy": entropy,
+                        "ci_low": ci_low, "ci_high": ci_high})
+
+    return pd.DataFrame(records, columns=[group_col, "entropy", "ci_low", "ci_high"])
+
+
+class BackgroundTask:
+    """Runs `fn(*args)` on a daemon thread; once `done`, read `result` or `error`."""
+
+    def __init__(self, fn, *args):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        threading.Thread(target=self._run, args=(fn, args), daemon=True).start()
+
+    def _run(self, fn, args):
+        try:
+            self.result = fn(*args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
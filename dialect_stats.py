@@ -0,0 +1,235 @@
+"""Batch independence tests for every survey question.
+
+Builds the term x age-group and term x state contingency tables for all
+questions in one pass over the responses, then scores them with chi-square,
+Cramér's V and seeded permutation tests. Kept free of Streamlit so the
+permutation workers can be imported by a process pool.
+"""
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+
+from dialect_fuzzy import DEFAULT_MIN_SIMILARITY, canonical_terms, load_term_map
+
+# Youngest to oldest
+AGE_ORDER = [
+    'Gen Z (Under 18)',
+    'Gen Z (18-24)',
+    'Millennial (25-34)',
+    'Millennial (35-44)',
+    'Gen X (45-54)',
+    'Boomer (55-64)',
+    'Boomer (65+)'
+]
+AGE_BINS = [-np.inf, 18, 25, 35, 45, 55, 65, np.inf]
+
+FACTORS = ["age_group", "state"]
+
+# Bump whenever term cleaning or age grouping changes, to invalidate cached results
+STATS_VERSION = 3
+
+# Cap on permuted labels held in memory at once per worker (~8 MB per int64 copy)
+PERMUTATION_BATCH_CELLS = 1_000_000
+
+# Each worker holds a few batch-sized arrays; keep the pool small on shared hosts
+MAX_WORKERS = 4
+
+
+def categorize_ages(years, current_year):
+    """Age-group labels (categorical, in AGE_ORDER) for a Series of birth years."""
+    return pd.cut(current_year - years, bins=AGE_BINS, labels=AGE_ORDER, right=False)
+
+
+def respondent_terms(responses, users, choices, current_year, min_share=0.05,
+                     term_map=None, min_similarity=DEFAULT_MIN_SIMILARITY):
+    """One row per response with its question, cleaned term, age group and state.
+
+    Free-text answers are folded into choices with the fuzzy `term_map`
+    (the persisted one by default) and the same variant patterns as the
+    Visualization page. Terms below `min_share` of their question's
+    responses are dropped, the same cut the roly poly chart uses, so
+    free-text one-offs don't blow up the tables.
+    """
+    df = responses[["user_id", "question_id", "choice_id", "other"]].merge(
+        users[["id", "year", "state"]], left_on="user_id", right_on="id", how="left"
+    ).drop(columns="id")
+
+    df = df.merge(
+        choices[["id", "value"]], left_on="choice_id", right_on="id", how="left"
+    )
+
+    if term_map is None:
+        term_map = load_term_map()
+    df["term"] = canonical_terms(df, term_map, min_similarity)
+    df["age_group"] = categorize_ages(df["year"], current_year)
+    df = df.dropna(subset=["question_id", "term"])
+
+    term_counts = df.groupby(["question_id", "term"]).size()
+    share = term_counts / term_counts.groupby(level="question_id").transform("sum")
+    common = share[share >= min_share].index
+    df = df[pd.MultiIndex.from_frame(df[["question_id", "term"]]).isin(common)]
+
+    return df[["question_id", "term", "age_group", "state"]]
+
+
+def chi_square(tables):
+    """Chi-square statistic, degrees of freedom and Cramér's V.
+
+    `tables` is a stack of contingency tables with shape (..., levels, terms).
+    Empty rows and columns (padding) are ignored.
+    """
+    tables = np.asarray(tables, dtype=float)
+    row_totals = tables.sum(axis=-1, keepdims=True)
+    col_totals = tables.sum(axis=-2, keepdims=True)
+    n = row_totals.sum(axis=-2, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = row_totals * col_totals / n
+        cells = np.where(expected > 0, (tables - expected) ** 2 / expected, 0.0)
+    stat = cells.sum(axis=(-2, -1))
+
+    rows = (row_totals[..., 0] > 0).sum(axis=-1)
+    cols = (col_totals[..., 0, :] > 0).sum(axis=-1)
+    dof = (rows - 1) * (cols - 1)
+
+    k = np.minimum(rows, cols) - 1
+    n = n[..., 0, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cramers_v = np.where(k > 0, np.sqrt(stat / (n * k)), np.nan)
+
+    return stat, dof, cramers_v
+
+
+def _permutation_pvalue(levels, terms, n_levels, n_terms, observed, n_permutations, seed):
+    """Permutation p-value for one question: shuffle group labels, recount, rescore."""
+    rng = np.random.default_rng(seed)
+    batch = max(1, PERMUTATION_BATCH_CELLS // max(len(levels), 1))
+    exceed = 0
+
+    for start in range(0, n_permutations, batch):
+        size = min(batch, n_permutations - start)
+        shuffled = rng.permuted(np.tile(levels, (size, 1)), axis=1)
+        flat = (np.arange(size)[:, None] * n_levels + shuffled) * n_terms + terms
+        tables = np.bincount(
+            flat.ravel(), minlength=size * n_levels * n_terms
+        ).reshape(size, n_levels, n_terms)
+        stat, _, _ = chi_square(tables)
+        exceed += np.count_nonzero(stat >= observed - 1e-9)
+
+    return (exceed + 1) / (n_permutations + 1)
+
+
+def independence_tests(responses, users, choices, current_year,
+                       n_permutations=199, seed=0, min_share=0.05, max_workers=None,
+                       term_map=None, min_similarity=DEFAULT_MIN_SIMILARITY):
+    """Test term independence from age group and from state for every question.
+
+    Returns one row per (question_id, factor) with the response count,
+    chi-square statistic, degrees of freedom, asymptotic p-value, Cramér's V
+    and permutation p-value.
+    """
+    df = respondent_terms(responses, users, choices, current_year, min_share,
+                          term_map, min_similarity)
+    results = []
+
+    if max_workers is None:
+        # Cores this process may run on, not the whole host's
+        available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        max_workers = min(MAX_WORKERS, available or 1)
+
+    # Spawn rather than fork: this runs inside the multi-threaded Streamlit
+    # server, and the workers only need numpy, pandas and scipy
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        for factor_idx, factor in enumerate(FACTORS):
+            sub = df.dropna(subset=[factor])
+            if sub.empty:
+                continue
+
+            # Integer codes; term codes are local to each question so the
+            # padded table stack stays (questions, levels, ~1 / min_share)
+            q_codes, question_ids = pd.factorize(sub["question_id"], sort=True)
+            l_codes, levels = pd.factorize(sub[factor], sort=True)
+            t_global = sub.groupby(["question_id", "term"], sort=True).ngroup().to_numpy()
+            t_codes = t_global - pd.Series(t_global).groupby(q_codes).transform("min").to_numpy()
+
+            n_questions, n_levels, n_terms = len(question_ids), len(levels), int(t_codes.max()) + 1
+            tables = np.bincount(
+                (q_codes * n_levels + l_codes) * n_terms + t_codes,
+                minlength=n_questions * n_levels * n_terms
+            ).reshape(n_questions, n_levels, n_terms)
+
+            stat, dof, cramers_v = chi_square(tables)
+            p_value = np.where(dof > 0, chi2.sf(stat, np.maximum(dof, 1)), np.nan)
+
+            # Split rows by question and run the permutation tests in parallel
+            order = np.argsort(q_codes, kind="stable")
+            bounds = np.cumsum(np.bincount(q_codes, minlength=n_questions))[:-1]
+            futures = {}
+            for qi, rows in enumerate(np.split(order, bounds)):
+                if dof[qi] <= 0 or n_permutations <= 0:
+                    continue
+                futures[qi] = pool.submit(
+                    _permutation_pvalue, l_codes[rows], t_codes[rows], n_levels, n_terms,
+                    stat[qi], n_permutations, np.random.SeedSequence([seed, factor_idx, qi])
+                )
+            perm_p_value = np.full(n_questions, np.nan)
+            for qi, future in futures.items():
+                perm_p_value[qi] = future.result()
+
+            results.append(pd.DataFrame({
+                "question_id": question_ids,
+                "factor": factor,
+                "n": tables.sum(axis=(1, 2)),
+                "chi2": stat,
+                "dof": dof,
+                "p_value": p_value,
+                "cramers_v": cramers_v,
+                "perm_p_value": perm_p_value,
+            }))
+
+    if not results:
+        return pd.DataFrame(columns=["question_id", "factor", "n", "chi2", "dof",
+                                     "p_value", "cramers_v", "perm_p_value"])
+    return pd.concat(results, ignore_index=True)
+
+
+def cached_independence_tests(responses, users, choices, current_year,
+                              cache_dir="data", **params):
+    """`independence_tests`, cached as CSV next to the downloaded data.
+
+    The cache file is keyed on a content hash of the tables and the fuzzy
+    term map, STATS_VERSION and the test parameters, so new data, new term
+    logic or different settings trigger a fresh run.
+    """
+    term_map = load_term_map()
+    content = [
+        int(pd.util.hash_pandas_object(df, index=False).sum())
+        for df in (
+            responses[["user_id", "question_id", "choice_id", "other"]],
+            users[["id", "year", "state"]],
+            choices[["id", "value"]],
+            term_map,
+        )
+    ]
+    signature = repr((STATS_VERSION, content, current_year, sorted(params.items())))
+    key = hashlib.md5(signature.encode()).hexdigest()[:12]
+    output = Path(cache_dir) / f"independence_{key}.csv"
+
+    if output.exists():
+        return pd.read_csv(output)
+
+    results = independence_tests(responses, users, choices, current_year,
+                                 term_map=term_map, **params)
+    # Write then rename so an interrupted run never leaves a truncated cache
+    output.parent.mkdir(exist_ok=True)
+    tmp = output.with_suffix(".tmp")
+    results.to_csv(tmp, index=False)
+    tmp.replace(output)
+    return results
@@ -4,15 +4,28 @@ import gdown
 import re
 from pathlib import Path
 import plotly.express as px
-import numpy as np
 from datetime import datetime
+from dialect_stats import AGE_ORDER, categorize_ages, cached_independence_tests
+from dialect_fuzzy import canonical_terms, load_term_map, update_term_map
+from dialect_sampling import (
+    SAMPLE_PATH, BackgroundTask, load_sample, save_sample,
+    stratified_sample, weighted_entropy, weighted_shares
+)
 
 st.set_page_config(page_title="Dialect Change Over Time", layout="wide")
 st.markdown("<h1 style='text-align: center;'>Visualization Page</h1>", unsafe_allow_html=True)
 st.write("<p style='text-align: center; font-size: 1.3rem;'>Scroll to see interactive visualizations.", unsafe_allow_html=True)
 
-@st.cache_data(show_spinner="Fetching data from Google Drive…", ttl=3600)
-def load_from_drive(_file_map):
+SODA_QID = 2  # Only the "sweetened carbonated beverage" question
+ROLY_POLY_QID = 21
+# The only questions the approximate charts draw, so the only ones sampled
+SAMPLED_QIDS = [SODA_QID, ROLY_POLY_QID]
+# Trigram similarity needed to fold a free-text answer into a listed choice
+FUZZY_MIN_SIMILARITY = 0.5
+current_year = datetime.now().year
+
+# Runs on a background thread, so errors are raised rather than shown with st.error
+def load_from_drive(file_map):
     dfs = {}
     data_folder = Path("data")
     data_folder.mkdir(exist_ok=True)
@@ -20,7 +33,7 @@ def load_from_drive(_file_map):
     # Google Drive file ID pattern (handles any share link)
     file_id_pattern = r"(?:id=|/d/|open\?id=|file/d/)([A-Za-z0-9_-]{25,})"
 
-    for name, link in _file_map.items():
+    for name, link in file_map.items():
 
         match = re.search(file_id_pattern, link)
         if match:
@@ -49,74 +62,139 @@ def load_from_drive(_file_map):
             else:
                 dfs[name] = pd.read_csv(output, low_memory=False, on_bad_lines='skip')
         except pd.errors.ParserError:
-            st.error(f"Could not parse {name}.csv. Make sure it is a valid CSV.")
-            st.stop()
+            raise ValueError(f"Could not parse {name}.csv. Make sure it is a valid CSV.")
     return dfs
 
 
+def join_responses(responses, users, choices):
+    joined = responses.merge(
+        users[["id", "year", "gender", "state"]], left_on="user_id", right_on="id", how="left"
+    ).drop(columns="id")
+
+    joined = joined.merge(
+        choices[["id", "value"]], left_on="choice_id", right_on="id", how="left"
+    ).drop(columns="id")
+
+    # Choice value, else free text folded into its nearest choice when close enough
+    joined["term"] = canonical_terms(joined, update_term_map(joined), FUZZY_MIN_SIMILARITY)
+
+    # Every full-table row counts once; sampled rows carry their stratum weight
+    joined["weight"] = 1.0
+    return joined
+
+
+def prepare_soda_data(joined):
+    responses_soda = joined[joined["question_id"] == SODA_QID].copy()
+
+    # Clean & Transform
+    responses_soda = responses_soda.dropna(subset=["year", "term"])
+    responses_soda["decade"] = (responses_soda["year"] // 10 * 10).astype(int)
+
+    # Aggregate
+    return weighted_shares(responses_soda, "decade")
+
+
+def prepare_soda_pop(joined):
+    responses = joined[joined["question_id"] == SODA_QID]
+    responses = responses[responses["term"].isin(["soda", "pop"])]
+    return responses.dropna(subset=["state", "term"])
+
+
+def prepare_roly_poly(joined):
+    responses_roly = joined[joined["question_id"] == ROLY_POLY_QID].copy()
+    responses_roly["age_group"] = categorize_ages(responses_roly["year"], current_year).astype(object)
+
+    responses_roly = responses_roly.dropna(subset=["age_group", "term"])
+
+    # Top choices
+    choice_counts = responses_roly.groupby("term")["weight"].sum()
+    top_choices = choice_counts[choice_counts >= responses_roly["weight"].sum() * 0.05].index
+    return responses_roly[responses_roly["term"].isin(top_choices)]
+
+
+def prepare_views(joined):
+    return {
+        "soda": prepare_soda_data(joined),
+        "soda_pop": prepare_soda_pop(joined),
+        "roly": prepare_roly_poly(joined),
+    }
+
+
+def aggregate_exact(file_map):
+    data = load_from_drive(file_map)
+    joined = join_responses(data["responses"], data["users"], data["choices"])
+    # Refresh the persisted sample so the next cold start has current estimates
+    save_sample(stratified_sample(joined, SAMPLED_QIDS))
+    return data, prepare_views(joined)
+
+
+# No TTL: the CSVs stay on disk under data/, so a periodic reload would only
+# drop every session back to estimates without fetching anything new
+@st.cache_resource
+def start_exact_aggregation(_file_map):
+    return BackgroundTask(aggregate_exact, dict(_file_map))
+
+
+# Keyed on the file's mtime so a rewritten sample is picked up right away
+@st.cache_data(max_entries=1)
+def load_sample_views(sample_mtime):
+    sample = load_sample()
+    # Older samples covered every question; drop the rest before remapping
+    sample = sample[sample["question_id"].isin(SAMPLED_QIDS)].copy()
+    # Re-map in case the sample predates the current term map
+    sample["term"] = canonical_terms(sample, load_term_map(), FUZZY_MIN_SIMILARITY)
+    return prepare_views(sample)
+
+
 try:
-    data = load_from_drive(st.secrets["drive_files"])
+    exact = start_exact_aggregation(st.secrets["drive_files"])
 except KeyError:
     st.error("❌ Missing `drive_files` in secrets.toml! Add it under `[drive_files]`.")
     st.stop()
-except Exception as e:
-    st.error(f"❌ Error loading data: {str(e)}")
-    st.exception(e)
-    st.stop()
 
-# Unpack data with error handling
-try:
-    questions = data["questions"]
-    choices = data["choices"]
-    users = data["users"]
-    responses = data["responses"]
-    raw_responses = responses.copy()
-    st.success("✅ All four datasets loaded successfully!")
-except KeyError as e:
-    st.error(f"❌ Missing required dataset: {str(e)}")
-    st.info("Available datasets: " + ", ".join(data.keys()))
-    st.stop()
-except Exception as e:
-    st.error(f"❌ Error unpacking data: {str(e)}")
-    st.exception(e)
+# Nothing to estimate from until the first full load has written a sample
+if not exact.done and not SAMPLE_PATH.exists():
+    with st.spinner("Fetching data from Google Drive…"):
+        exact.wait()
+
+if exact.error is not None:
+    st.error(f"❌ Error loading data: {str(exact.error)}")
+    st.exception(exact.error)
+    # Don't keep a failed load cached; the next run retries
+    start_exact_aggregation.clear()
     st.stop()
 
+approximate = not exact.done
+
+if approximate:
+    views = load_sample_views(SAMPLE_PATH.stat().st_mtime)
+    st.info("⚡ Showing estimates from a stratified sample of responses, with 95% confidence intervals. "
+            "Charts switch to exact counts once full aggregation finishes.")
+
+    @st.fragment(run_every="2s")
+    def swap_in_exact_charts():
+        if exact.done:
+            st.rerun()
+
+    swap_in_exact_charts()
+else:
+    data, views = exact.result
+    # Unpack data with error handling
+    try:
+        questions = data["questions"]
+        choices = data["choices"]
+        users = data["users"]
+        raw_responses = data["responses"]
+        st.success("✅ All four datasets loaded successfully!")
+    except KeyError as e:
+        st.error(f"❌ Missing required dataset: {str(e)}")
+        st.info("Available datasets: " + ", ".join(data.keys()))
+        st.stop()
+
 st.markdown("---")
 st.subheader("U.S. Dialect Word Usage Over Time")
 
-@st.cache_data
-def prepare_soda_data(responses, users, choices):
-    soda_qid = 2
-    responses_soda = responses[responses["question_id"] == soda_qid].copy()
-    
-    responses_soda = responses_soda.merge(
-        users[["id", "year"]], left_on="user_id", right_on="id", how="left"
-    )
-    
-    responses_soda = responses_soda.merge(
-        choices[["id", "value"]], left_on="choice_id", right_on="id", how="left"
-    )
-    
-    responses_soda["term"] = responses_soda["value"].combine_first(responses_soda["other"])
-    
-    # Clean & Transform
-    responses_soda = responses_soda.dropna(subset=["year", "term"])
-    responses_soda["decade"] = (responses_soda["year"] // 10 * 10).astype(int)
-    responses_soda["term"] = responses_soda["term"].str.strip().str.lower()
-    
-    # Aggregate
-    counts = (
-        responses_soda.groupby(["decade", "term"])
-        .size()
-        .reset_index(name="count")
-    )
-    
-    totals = counts.groupby("decade")["count"].transform("sum")
-    counts["percent"] = (counts["count"] / totals * 100).round(1)
-    
-    return counts
-
-counts = prepare_soda_data(responses, users, choices)
+counts = views["soda"]
 
 # Get Top 5 Terms Overall 
 top_terms = (
@@ -148,6 +226,9 @@ fig = px.line(
         "percent": True,
         "decade": True,
     },
+    # Interval arms only while estimating from the sample
+    error_y=(filtered["ci_high"] - filtered["percent"]) if approximate else None,
+    error_y_minus=(filtered["percent"] - filtered["ci_low"]) if approximate else None,
     title="Change in Word Usage Over Birth Decades (Top 5 Terms, Normalized by Birth Year)"
 )
 
@@ -164,38 +245,7 @@ fig.update_layout(
 st.plotly_chart(fig, width='stretch')
 
 
-QUESTION_ID = 2  # Only the "sweetened carbonated beverage" question
-responses = responses[responses["question_id"] == QUESTION_ID].copy()
-
-responses = responses.merge(
-    users[["id", "year", "gender", "state"]],
-    left_on="user_id",
-    right_on="id",
-    how="left"
-)
-
-responses = responses.merge(
-    choices[["id", "value"]],
-    left_on="choice_id",
-    right_on="id",
-    how="left"
-)
-
-responses["term"] = responses["value"].combine_first(responses["other"]).str.lower().str.strip()
-responses = responses[responses["term"].isin(["soda", "pop"])]
-responses = responses.dropna(subset=["state", "term"])
-
-# Shannon Entropy Function
-def shannon_entropy(series):
-    counts = series.value_counts(normalize=True)
-    return -np.sum(counts * np.log2(counts))
-
-# Compute lexical diversity per state
-entropy_by_state = (
-    responses.groupby("state")["term"]
-    .apply(shannon_entropy)
-    .reset_index(name="entropy")
-)
+responses = views["soda_pop"]
 
 st.sidebar.header("Filter Controls")
 
@@ -221,11 +271,9 @@ filtered = responses[
     (responses["year"].between(year_range[0], year_range[1])) &
     (responses["gender"].isin(gender_filter))
 ]
-entropy_by_state = (
-    filtered.groupby("state")["term"]
-    .apply(shannon_entropy)
-    .reset_index(name="entropy")
-)
+# Compute lexical diversity per state
+# Bootstrap intervals are only shown, and only affordable, on the sample
+entropy_by_state = weighted_entropy(filtered, "state", n_boot=200 if approximate else 0)
 
 fig = px.choropleth(
     entropy_by_state,
@@ -235,7 +283,7 @@ fig = px.choropleth(
     color_continuous_scale="plasma",
     scope="usa",
     labels={"entropy": "Lexical Diversity (Shannon Entropy)"},
-    hover_data={"state": True, "entropy": True}
+    hover_data={"state": True, "entropy": True, "ci_low": approximate, "ci_high": approximate}
 )
 
 fig.update_layout(
@@ -258,91 +306,16 @@ st.markdown("---")
 st.subheader("Roly Poly Question: Age Group Analysis")
 st.write("What do you call a creature that rolls up into a ball when when you touch it?")
 
-ROLY_POLY_QID = 21
-responses_roly = raw_responses[raw_responses["question_id"] == ROLY_POLY_QID].copy()
-
-# Merge with users to get age
-responses_roly = responses_roly.merge(
-    users[["id", "year"]],
-    left_on="user_id",
-    right_on="id",
-    how="left"
-)
-
-# Merge with choices to get values
-responses_roly = responses_roly.merge(
-    choices[["id", "value"]],
-    left_on="choice_id",
-    right_on="id",
-    how="left"
-)
-
-current_year = datetime.now().year
-responses_roly["age"] = current_year - responses_roly["year"]
-
-def categorize_age(age):
-    if pd.isna(age):
-        return None
-    if age < 18:
-        return 'Gen Z (Under 18)'
-    elif age < 25:
-        return 'Gen Z (18-24)'
-    elif age < 35:
-        return 'Millennial (25-34)'
-    elif age < 45:
-        return 'Millennial (35-44)'
-    elif age < 55:
-        return 'Gen X (45-54)'
-    elif age < 65:
-        return 'Boomer (55-64)'
-    else:
-        return 'Boomer (65+)'
-
-responses_roly["age_group"] = responses_roly["age"].apply(categorize_age)
-
-# Clean the term values
-responses_roly["term"] = responses_roly["value"].combine_first(responses_roly["other"])
-responses_roly["term"] = responses_roly["term"].str.lower().str.strip()
-
-# Regex to match differnet variations of "roly poly"
-responses_roly["term"] = responses_roly["term"].replace(
-    to_replace=r'(?i)^(roly|rollie|rolly|roley)[\s\-]*poly.*$',
-    value='roly poly',
-    regex=True
-)
-
-responses_roly = responses_roly.dropna(subset=["age_group", "term"])
-
-# Top choices
-choice_counts = responses_roly["term"].value_counts()
-top_choices = choice_counts[choice_counts >= len(responses_roly) * 0.05].index
-responses_roly = responses_roly[responses_roly["term"].isin(top_choices)]
-
-contingency = pd.crosstab(responses_roly["age_group"], responses_roly["term"])
+responses_roly = views["roly"]
 
 # Youngest to oldest
-age_order = [
-    'Gen Z (Under 18)',
-    'Gen Z (18-24)',
-    'Millennial (25-34)',
-    'Millennial (35-44)',
-    'Gen X (45-54)',
-    'Boomer (55-64)',
-    'Boomer (65+)'
-]
-age_order_present = [age for age in age_order if age in contingency.index]
-contingency = contingency.reindex(age_order_present)
+age_order_present = [age for age in AGE_ORDER if age in set(responses_roly["age_group"])]
 
-contingency_pct = contingency.div(contingency.sum(axis=1), axis=0) * 100
 col1, col2 = st.columns(2)
 
 with col1:
     st.markdown("#### Usage by Age Group")
-    bar_data = contingency_pct.reset_index().melt(
-        id_vars="age_group",
-        var_name="term",
-        value_name="percentage"
-    )
+    bar_data = weighted_shares(responses_roly, "age_group").rename(columns={"percent": "percentage"})
     
     fig_bar = px.bar(
         bar_data,
@@ -350,6 +323,9 @@ with col1:
         y="percentage",
         color="age_group",
         barmode="group",
+        category_orders={"age_group": age_order_present},
+        error_y=(bar_data["ci_high"] - bar_data["percentage"]) if approximate else None,
+        error_y_minus=(bar_data["percentage"] - bar_data["ci_low"]) if approximate else None,
         labels={
             "percentage": "% Using Term",
             "term": "Dialect Term",
@@ -371,7 +347,7 @@ with col1:
 
 with col2:
     st.markdown("#### Overall Response Distribution")
-    total_counts = responses_roly["term"].value_counts()
+    total_counts = responses_roly.groupby("term")["weight"].sum().round().sort_values(ascending=False)
     
     fig_pie = px.pie(
         values=total_counts.values,
@@ -390,4 +366,64 @@ with col2:
         showlegend=True
     )
     
-    st.plotly_chart(fig_pie, width='stretch')
\ No newline at end of file
+    st.plotly_chart(fig_pie, width='stretch')
+
+# Independence tests across all questions
+st.markdown("---")
+st.subheader("Which Words Are Changing Fastest?")
+st.write("Chi-square and permutation tests of term × age group and term × state for every question, ranked by Cramér's V.")
+
+@st.cache_data(show_spinner="Running independence tests across all questions…")
+def load_independence_tests(_responses, _users, _choices, current_year):
+    return cached_independence_tests(
+        _responses, _users, _choices, current_year, min_similarity=FUZZY_MIN_SIMILARITY
+    )
+
+# The last section, so stopping here leaves the charts above in place
+if approximate:
+    st.info("Independence tests run once the full responses have loaded.")
+    st.stop()
+
+stats = load_independence_tests(raw_responses, users, choices, current_year)
+if "age_group" not in set(stats["factor"]):
+    st.info("Not enough birth-year data to rank questions by age group.")
+    st.stop()
+
+ranking = stats.pivot(
+    index="question_id",
+    columns="factor",
+    values=["cramers_v", "p_value", "perm_p_value"]
+)
+ranking.columns = [f"{factor}_{metric}" for metric, factor in ranking.columns]
+ranking = ranking.sort_values("age_group_cramers_v", ascending=False).reset_index()
+ranking["question_id"] = ranking["question_id"].astype(str)
+
+if "text" in questions.columns:
+    question_text = questions[["id", "text"]].assign(id=questions["id"].astype(str))
+    ranking = ranking.merge(
+        question_text, left_on="question_id", right_on="id", how="left"
+    ).drop(columns="id")
+
+top_n = st.sidebar.slider("Questions to rank:", 5, 50, value=15)
+
+fig_rank = px.bar(
+    ranking.head(top_n),
+    x="age_group_cramers_v",
+    y="question_id",
+    orientation="h",
+    hover_data=[col for col in ranking.columns if col not in ("question_id", "age_group_cramers_v")],
+    labels={"age_group_cramers_v": "Cramér's V (Term × Age Group)", "question_id": "Question ID"},
+    color_discrete_sequence=px.colors.qualitative.Set3
+)
+fig_rank.update_layout(
+    yaxis=dict(autorange="reversed"),
+    hovermode="closest",
+    height=500
+)
+
+st.plotly_chart(fig_rank, width='stretch')
+st.dataframe(ranking, width='stretch')
+st.markdown("""
+**Cramér's V** measures how strongly word choice depends on age group or state  
+(0 = no association, 1 = perfectly determined). Permutation p-values come from shuffling age groups / states within each question.
+""")